@@ -1,17 +1,94 @@
+import asyncio
+import collections
+import logging
 import os
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header, status
-from fastapi.responses import JSONResponse
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException, Depends, Header, Query, status
+from fastapi.responses import JSONResponse, Response
 import fitz  # PyMuPDF
-import tempfile
 from typing import Dict, List, Optional
 import uvicorn
 
-app = FastAPI(title="PDF Comparison API", version="1.1.0")
+try:
+    # Décodage SIMD (SSSE3/AVX2), ~4-10x plus rapide que la stdlib sur les
+    # payloads Base64 de plusieurs Mo ; API compatible
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+try:
+    # Sérialisation JSON SIMD (3-10x plus rapide sur les payloads texte)
+    import orjson
+    from fastapi.responses import ORJSONResponse as DefaultResponse
+
+    _dumps = orjson.dumps
+except ImportError:
+    import json
+
+    DefaultResponse = JSONResponse
+
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+try:
+    # Hachage SIMD (SSE4.2/AVX2) pour identifier un PDF déjà comparé
+    import xxhash
+
+    def _hash_pdf(pdf_bytes) -> int:
+        return xxhash.xxh3_64_intdigest(pdf_bytes)
+except ImportError:
+    import hashlib
+
+    def _hash_pdf(pdf_bytes) -> bytes:
+        return hashlib.blake2b(pdf_bytes, digest_size=16).digest()
+
+app = FastAPI(title="PDF Comparison API", version="1.1.0", default_response_class=DefaultResponse)
+
+# Pool pour le travail PyMuPDF. Par défaut des threads : get_text() relâche
+# le GIL dans le code C, donc les extractions tournent en parallèle sans
+# bloquer l'event loop. Avec USE_PROCESS_POOL=1, un pool de processus forkés
+# (parallélisme CPU réel, utile avec un seul worker uvicorn) ; les workers
+# héritent des caches en copy-on-write et revalident le mtime du modèle à
+# chaque requête (clé du cache de résultats, contrôle dans get_empty_lines),
+# donc un re-upload du modèle est vu même sans l'invalidation du parent.
+if os.getenv("USE_PROCESS_POOL") == "1":
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    multiprocessing.set_start_method("fork", force=True)
+    _PDF_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+else:
+    _PDF_POOL = ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 1) * 2))
+
+# Journalisation : remplace les print() du chemin chaud (verrou stdout +
+# write(2) par requête) ; désactivable en production via LOG_LEVEL=WARNING
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("pdfcmp")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
 # Configuration - adaptée pour le déploiement
 MODELE_VIERGE_PATH = os.getenv("MODELE_VIERGE_PATH", "modele_vierge.pdf")
 PAGES_A_COMPARER = [1, 3, 11, 12]  # pages 1, 3, 11, 12 (indexées à 0)
 
+# Existence du modèle vierge, mémorisée pour épargner un stat() par requête ;
+# remise à jour par les uploads et par /health
+_MODEL_EXISTS: bool = os.path.exists(MODELE_VIERGE_PATH)
+
+def modele_existe() -> bool:
+    """Existence du modèle vierge, sans stat() tant que le drapeau est vrai.
+
+    Le drapeau est par processus : le modèle a pu être uploadé via un autre
+    worker gunicorn. Quand il est faux, on refait un vrai stat() avant de
+    refuser la requête — le coût ne s'applique qu'au chemin d'échec.
+    """
+    global _MODEL_EXISTS
+    if not _MODEL_EXISTS:
+        _MODEL_EXISTS = os.path.exists(MODELE_VIERGE_PATH)
+    return _MODEL_EXISTS
+
 # Configuration de sécurité
 class APIKeyError(HTTPException):
     def __init__(self, detail: str):
@@ -21,67 +98,286 @@ class APIKeyError(HTTPException):
             headers={"WWW-Authenticate": "ApiKey"},
         )
 
+# Clés valides parsées une fois à l'import (support de plusieurs clés
+# séparées par des virgules) : plus de split + liste par requête
+_VALID_KEYS: frozenset = frozenset(
+    key.strip() for key in (os.getenv("API_KEY") or "").split(",") if key.strip()
+)
+
 async def get_api_key(x_api_key: Optional[str] = Header(None)) -> str:
     """Valide la clé API fournie dans les headers."""
     if not x_api_key:
         raise APIKeyError("En-tête X-API-Key manquant")
-    
-    # Récupérer les clés valides depuis les variables d'environnement
-    valid_api_key = os.getenv("API_KEY")
-    if not valid_api_key:
+
+    if not _VALID_KEYS:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Clé API non configurée sur le serveur"
         )
-    
-    # Support de plusieurs clés (séparées par des virgules)
-    valid_keys = [key.strip() for key in valid_api_key.split(",")]
-    
-    if x_api_key not in valid_keys:
+
+    if x_api_key not in _VALID_KEYS:
         raise APIKeyError("Clé API invalide")
-    
-    # Log optionnel de l'utilisation (masquage partiel de la clé)
-    print(f"🔑 Accès autorisé avec la clé: {x_api_key[:8]}...")
+
     return x_api_key
 
-def nettoyer_lignes(texte: str) -> set:
-    """Nettoie et filtre les lignes de texte."""
-    return set(
-        line.strip()
-        for line in texte.strip().splitlines()
-        if line.strip() and "docusign envelope id" not in line.lower()
-    )
+def decoder_base64(file_content: str):
+    """Décode une chaîne Base64 en objet bytes-like prêt pour fitz.open(stream=...).
+
+    Avec pybase64, décode directement dans un bytearray préalloué : pas de
+    copie intermédiaire, donc un pic mémoire réduit sur les gros fichiers.
+    Lève ValueError si le contenu n'est pas du Base64 valide (binascii.Error
+    en est une sous-classe, mais le décodeur stdlib peut aussi lever un
+    ValueError nu sur une entrée non-ASCII).
+    """
+    # Les clients JSON laissent parfois des blancs en tête/queue : un strip
+    # unique évite les reprises internes du décodeur
+    file_content = file_content.strip()
+    if hasattr(base64, "b64decode_as_bytearray"):
+        return base64.b64decode_as_bytearray(file_content)
+    return base64.b64decode(file_content)
+
+def base64_semble_pdf(file_content: str) -> bool:
+    """Vérifie l'en-tête %PDF en ne décodant que les premiers caractères Base64.
 
-def extract_page_diffs(filled_pdf_path: str, empty_pdf_path: str, pages: List[int]) -> Dict[str, str]:
-    """Extrait les différences entre deux PDF pour les pages spécifiées."""
+    Rejette les payloads qui ne sont pas des PDF en O(1), avant d'allouer
+    les ~11 Mo du décodage complet.
+    """
     try:
-        doc_filled = fitz.open(filled_pdf_path)
-        doc_empty = fitz.open(empty_pdf_path)
+        return est_pdf(base64.b64decode(file_content[:64].lstrip()[:8]))
+    except ValueError:
+        return False
+
+# En-tête "%PDF" sous forme d'entier 32 bits : une seule comparaison
+_PDF_MAGIC = int.from_bytes(b"%PDF", "little")
+
+def est_pdf(pdf_bytes) -> bool:
+    """Vérifie l'en-tête %PDF du fichier."""
+    return len(pdf_bytes) >= 4 and int.from_bytes(pdf_bytes[:4], "little") == _PDF_MAGIC
+
+# Filtre des signatures DocuSign, précompilé (évite un .lower() par ligne)
+_DOCUSIGN_RE = re.compile(r"docusign envelope id", re.IGNORECASE)
+
+# Extraction texte minimale : pas de tri par layout ni de ligatures, il ne
+# s'agit que de comparer des lignes (mêmes flags des deux côtés du diff)
+_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+
+def nettoyer_lignes(texte: str) -> frozenset:
+    """Nettoie et filtre les lignes de texte.
+
+    Retourne un frozenset : hachable (donc compatible avec les caches) et
+    construit en un seul appel C depuis le tuple intermédiaire.
+    """
+    stripped = (line.strip() for line in texte.splitlines())
+    lines = tuple(line for line in stripped if line and not _DOCUSIGN_RE.search(line))
+    return frozenset(lines)
+
+# Cache du modèle vierge : le fichier ne change qu'à l'upload, inutile de le
+# rouvrir et re-extraire à chaque comparaison
+_EMPTY_CACHE: Dict[int, frozenset] = {}
+_EMPTY_MTIME: Optional[float] = None
+
+# Document du modèle vierge gardé ouvert entre les requêtes (~3 ms de
+# fitz.open économisés par comparaison) ; protégé par un verrou car un
+# Document PyMuPDF ne doit pas être utilisé par plusieurs threads à la fois
+_EMPTY_DOC: Optional[fitz.Document] = None
+_EMPTY_DOC_MTIME: Optional[float] = None
+_EMPTY_DOC_LOCK = threading.Lock()
+
+def _close_empty_doc():
+    """Ferme le Document du modèle vierge.
+
+    À appeler avec _EMPTY_DOC_LOCK tenu.
+    """
+    global _EMPTY_DOC
+    if _EMPTY_DOC is not None:
+        _EMPTY_DOC.close()
+        _EMPTY_DOC = None
+
+def _get_empty_doc() -> fitz.Document:
+    """Retourne le Document du modèle vierge, rouvert seulement si le fichier a changé.
+
+    À appeler avec _EMPTY_DOC_LOCK tenu.
+    """
+    global _EMPTY_DOC, _EMPTY_DOC_MTIME
+    mtime = os.path.getmtime(MODELE_VIERGE_PATH)
+    if _EMPTY_DOC is None or mtime != _EMPTY_DOC_MTIME:
+        _close_empty_doc()
+        _EMPTY_DOC = fitz.open(MODELE_VIERGE_PATH)
+        _EMPTY_DOC_MTIME = mtime
+    return _EMPTY_DOC
+
+def invalidate_empty_cache():
+    """Invalide le cache du modèle vierge (après un nouvel upload)."""
+    global _EMPTY_MTIME
+    _EMPTY_CACHE.clear()
+    _EMPTY_MTIME = None
+    with _EMPTY_DOC_LOCK:
+        _close_empty_doc()
+
+def get_empty_lines(page_index: int) -> frozenset:
+    """Retourne les lignes nettoyées d'une page du modèle vierge (avec cache).
+
+    Le cache est indexé par indice de page (base 0) et invalidé automatiquement
+    si le fichier modèle a changé sur disque (mtime).
+    """
+    global _EMPTY_MTIME
+    mtime = os.path.getmtime(MODELE_VIERGE_PATH)
+    if mtime != _EMPTY_MTIME:
+        _EMPTY_CACHE.clear()
+        _EMPTY_MTIME = mtime
+
+    if page_index not in _EMPTY_CACHE:
+        with _EMPTY_DOC_LOCK:
+            doc_empty = _get_empty_doc()
+            # Test de borne explicite : pas d'exception à construire pour les
+            # pages hors du modèle, simple frozenset vide
+            if 0 <= page_index < doc_empty.page_count:
+                empty_text = doc_empty.load_page(page_index).get_text("text", flags=_TEXT_FLAGS, sort=False)
+            else:
+                empty_text = ""
+        # Les lignes du modèle se retrouvent dans chaque PDF rempli : les
+        # interner rend leur hachage/comparaison quasi gratuits au diff
+        _EMPTY_CACHE[page_index] = frozenset(sys.intern(s) for s in nettoyer_lignes(empty_text))
+
+    return _EMPTY_CACHE[page_index]
+
+def _write_model(content) -> None:
+    """Écrit le modèle vierge sur disque (à appeler hors de l'event loop)."""
+    with open("modele_vierge.pdf", "wb") as f:
+        f.write(content)
+
+def prime_empty_cache():
+    """Précalcule les lignes nettoyées de toutes les pages du modèle vierge.
+
+    Appelé au démarrage et après chaque upload du modèle : les requêtes ne
+    touchent alors plus jamais PyMuPDF côté modèle vierge.
+    """
+    if not os.path.exists(MODELE_VIERGE_PATH):
+        return
+    with _EMPTY_DOC_LOCK:
+        page_count = _get_empty_doc().page_count
+    for page_index in range(page_count):
+        get_empty_lines(page_index)
+
+@app.on_event("startup")
+async def startup_event():
+    """Préchauffe le cache du modèle vierge sans retarder le démarrage.
+
+    Le préchauffage force aussi l'initialisation de PyMuPDF, que la première
+    requête n'a donc plus à payer. Le future n'est pas attendu : uvicorn
+    commence à servir dès le retour du hook, l'extraction se poursuit dans
+    l'executor (une première requête trop précoce recalcule au pire les
+    pages pas encore en cache).
+    """
+    asyncio.get_running_loop().run_in_executor(None, prime_empty_cache)
+
+# Cache LRU des résultats : les clients (retries Power Automate notamment)
+# resoumettent souvent le même PDF à l'identique
+_RESULT_CACHE: "collections.OrderedDict" = collections.OrderedDict()
+_RESULT_CACHE_MAX = 64
+_RESULT_CACHE_LOCK = threading.Lock()
+
+def extract_page_diffs(filled_bytes: bytes, pages: List[int]):
+    """Extrait les différences entre le PDF rempli (en mémoire) et le modèle vierge.
+
+    Retourne (diffs_par_page, payload) où payload est le dict déjà sérialisé
+    en JSON : un hit de cache renvoie les octets tels quels, sans ré-encodage.
+    """
+    # Le mtime du modèle fait partie de la clé, relevé par un stat() frais :
+    # re-uploader le modèle invalide les entrées même dans les workers
+    # forkés, qui ne voient pas l'invalidate_empty_cache() du parent
+    try:
+        model_mtime = os.path.getmtime(MODELE_VIERGE_PATH)
+    except OSError:
+        model_mtime = None
+    cache_key = (_hash_pdf(filled_bytes), tuple(pages), model_mtime)
+    with _RESULT_CACHE_LOCK:
+        if cache_key in _RESULT_CACHE:
+            _RESULT_CACHE.move_to_end(cache_key)
+            return _RESULT_CACHE[cache_key]
+
+    try:
+        doc_filled = fitz.open(stream=filled_bytes, filetype="pdf")
+        page_count = doc_filled.page_count
         diffs_par_page = {}
-        
-        for page_index in pages:
+
+        # Indices (base 0) des pages demandées présentes dans le document
+        valid_indices = sorted({p - 1 for p in pages if 0 < p <= page_count})
+
+        def _texte_page(idx: int) -> str:
+            # Chaque thread ouvre son propre Document : un Document PyMuPDF
+            # n'est pas thread-safe (léger surcoût d'ouverture, mais la
+            # correction prime). Sur les très longs documents, le restreindre
+            # à la page visée évite de parcourir toute la structure /Pages.
+            doc = fitz.open(stream=filled_bytes, filetype="pdf")
             try:
-                filled_text = doc_filled.load_page(page_index - 1).get_text()
-                empty_text = doc_empty.load_page(page_index - 1).get_text()
-            except IndexError:
-                filled_text = ""
-                empty_text = ""
-            
+                if page_count > 100:
+                    doc.select([idx])
+                    return doc.load_page(0).get_text("text", flags=_TEXT_FLAGS, sort=False)
+                return doc.load_page(idx).get_text("text", flags=_TEXT_FLAGS, sort=False)
+            finally:
+                doc.close()
+
+        if len(valid_indices) > 1:
+            # get_text() relâche le GIL : les pages s'extraient en parallèle
+            with ThreadPoolExecutor(max_workers=min(len(valid_indices), 4)) as pool_pages:
+                textes = dict(zip(valid_indices, pool_pages.map(_texte_page, valid_indices)))
+        elif valid_indices:
+            # Une seule page : extraction directe, sans threads
+            if page_count > 100:
+                doc_filled.select(valid_indices)
+                textes = {valid_indices[0]: doc_filled.load_page(0).get_text("text", flags=_TEXT_FLAGS, sort=False)}
+            else:
+                textes = {valid_indices[0]: doc_filled.load_page(valid_indices[0]).get_text("text", flags=_TEXT_FLAGS, sort=False)}
+        else:
+            textes = {}
+
+        for page_index in pages:
+            filled_text = textes.get(page_index - 1, "")
+
             filled_lines = nettoyer_lignes(filled_text)
-            empty_lines = nettoyer_lignes(empty_text)
-            diff_lines = filled_lines - empty_lines
-            diff_text = "\n".join(diff_lines).strip()
-            
+            empty_lines = get_empty_lines(page_index - 1)
+            diff_lines = filled_lines.difference(empty_lines)
+            # Tri unique pour une sortie stable d'une requête à l'autre
+            diff_text = "\n".join(sorted(diff_lines))
+
             # Format de clé demandé : "page11", "page12", etc.
             page_key = f"page{page_index}"
             diffs_par_page[page_key] = diff_text
-        
+
         doc_filled.close()
-        doc_empty.close()
-        return diffs_par_page
-        
+
+        resultat = (diffs_par_page, _dumps(diffs_par_page))
+        with _RESULT_CACHE_LOCK:
+            _RESULT_CACHE[cache_key] = resultat
+            if len(_RESULT_CACHE) > _RESULT_CACHE_MAX:
+                _RESULT_CACHE.popitem(last=False)
+        return resultat
+
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erreur lors de l'extraction : {str(e)}")
+        # Exception simple et picklable : une HTTPException construite avec
+        # des arguments nommés ne survit pas au retour depuis un worker du
+        # pool de processus (args vides → BrokenProcessPool définitif)
+        raise ValueError(f"Erreur lors de l'extraction : {str(e)}") from e
+
+def parser_pages(pages: str) -> List[int]:
+    """Convertit la chaîne "1,3,11,12" en liste d'entiers (ValueError si invalide)."""
+    return [int(p.strip()) for p in pages.split(',')]
+
+async def _compare_bytes(pdf_bytes, pages_to_compare: List[int]):
+    """Chemin commun des endpoints /compare-pdf* : extraction hors de l'event loop.
+
+    Centralise le passage par le pool pour que le cache, le stream-open et la
+    parallélisation s'appliquent uniformément à tous les endpoints. Retourne
+    (diffs_par_page, payload_json). Traduit l'erreur d'extraction en
+    HTTPException côté parent, une fois sortie du pool.
+    """
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            _PDF_POOL, extract_page_diffs, pdf_bytes, pages_to_compare
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 # Routes publiques (sans authentification)
 @app.get("/")
@@ -92,7 +388,11 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Vérification de l'état de l'API."""
-    return {"status": "healthy", "model_file_exists": os.path.exists(MODELE_VIERGE_PATH)}
+    # Seul endpoint à refaire un vrai stat(), pour détecter les changements
+    # hors-bande ; il rafraîchit le drapeau au passage
+    global _MODEL_EXISTS
+    _MODEL_EXISTS = os.path.exists(MODELE_VIERGE_PATH)
+    return {"status": "healthy", "model_file_exists": _MODEL_EXISTS}
 
 # Routes protégées (avec authentification par clé API)
 @app.post("/upload-model")
@@ -106,12 +406,18 @@ async def upload_model(
     """
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Le fichier doit être un PDF")
-    
+
+    global _MODEL_EXISTS
     try:
         content = await file.read()
-        with open("modele_vierge.pdf", "wb") as f:
-            f.write(content)
-        print(f"📁 Modèle vierge uploadé par la clé: {api_key[:8]}...")
+        # Écriture disque et préchauffage hors de l'event loop : un modèle de
+        # 15 Mo ne doit pas geler les requêtes concurrentes
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _write_model, content)
+        _MODEL_EXISTS = True
+        invalidate_empty_cache()
+        await loop.run_in_executor(None, prime_empty_cache)
+        logger.info("📁 Modèle vierge uploadé par la clé: %s...", api_key[:8])
         return {"message": "Modèle vierge uploadé avec succès"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur lors de l'upload : {str(e)}")
@@ -131,62 +437,75 @@ async def upload_model_base64(
         "filename": "modele_vierge.pdf"
     }
     """
-    import base64
-    
+    global _MODEL_EXISTS
     try:
         # Extraire les données du request
         file_content = request.get("file_content", "")
         filename = request.get("filename", "modele_vierge.pdf")
         
         if not file_content:
-            return JSONResponse(
+            return DefaultResponse(
                 status_code=400,
                 content={"success": False, "error": "file_content manquant"}
             )
         
         # Vérifier la taille
         if len(file_content) > 20000000:  # Limite plus élevée pour le modèle
-            return JSONResponse(
+            return DefaultResponse(
                 status_code=413,
                 content={"success": False, "error": "Fichier modèle trop volumineux (max ~15MB)"}
             )
-        
+
+        # Vérifier l'en-tête avant de décoder tout le payload
+        if not base64_semble_pdf(file_content):
+            return DefaultResponse(
+                status_code=400,
+                content={"success": False, "error": "Le fichier ne semble pas être un PDF valide"}
+            )
+
         # Décoder le Base64
         try:
-            pdf_bytes = base64.b64decode(file_content)
-        except Exception as e:
-            return JSONResponse(
+            pdf_bytes = decoder_base64(file_content)
+        except ValueError as e:
+            return DefaultResponse(
                 status_code=400,
                 content={"success": False, "error": f"Base64 invalide: {str(e)}"}
             )
-        
+        # Libérer la chaîne source (~33% plus grosse que le PDF) au plus tôt
+        file_content = None
+        request["file_content"] = None
+
         # Vérifier que c'est un PDF valide
-        if not pdf_bytes.startswith(b'%PDF'):
-            return JSONResponse(
+        if not est_pdf(pdf_bytes):
+            return DefaultResponse(
                 status_code=400,
                 content={"success": False, "error": "Le fichier ne semble pas être un PDF valide"}
             )
         
-        # Sauvegarder le modèle vierge
+        # Sauvegarder le modèle vierge (écriture et préchauffage hors de
+        # l'event loop)
         try:
-            with open("modele_vierge.pdf", "wb") as f:
-                f.write(pdf_bytes)
-            
-            print(f"📁 Modèle vierge Base64 uploadé par la clé: {api_key[:8]}...")
-            return JSONResponse(content={
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, _write_model, pdf_bytes)
+            _MODEL_EXISTS = True
+            invalidate_empty_cache()
+            await loop.run_in_executor(None, prime_empty_cache)
+
+            logger.info("📁 Modèle vierge Base64 uploadé par la clé: %s...", api_key[:8])
+            return DefaultResponse(content={
                 "success": True,
                 "message": f"Modèle vierge '{filename}' uploadé avec succès",
                 "file_size_kb": len(pdf_bytes) // 1024
             })
             
         except Exception as e:
-            return JSONResponse(
+            return DefaultResponse(
                 status_code=500,
                 content={"success": False, "error": f"Erreur lors de la sauvegarde: {str(e)}"}
             )
             
     except Exception as e:
-        return JSONResponse(
+        return DefaultResponse(
             status_code=500,
             content={"success": False, "error": f"Erreur serveur: {str(e)}"}
         )
@@ -194,56 +513,43 @@ async def upload_model_base64(
 @app.post("/compare-pdf")
 async def compare_pdf(
     file: UploadFile = File(...),
-    pages: str = "1,3,11,12",  # Pages sous forme de chaîne séparée par des virgules
+    pages: List[int] = Query(default=PAGES_A_COMPARER),  # ex: ?pages=1&pages=3&pages=11
     api_key: str = Depends(get_api_key)
 ):
     """
     Compare un fichier PDF uploadé avec le modèle vierge avec des pages personnalisées.
     Nécessite une clé API valide.
-    
+
     - **file**: Fichier PDF à comparer
-    - **pages**: Pages à comparer sous forme de chaîne séparée par des virgules (ex: "1,3,11,12")
-    
+    - **pages**: Pages à comparer, paramètre répétable (ex: ?pages=1&pages=3&pages=11)
+
     Retourne un JSON avec les différences par page au format {"page11": "texte", "page12": "texte"}
     """
-    
+
     # Vérifier le type de fichier
     if not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Le fichier doit être un PDF")
-    
+
     # Vérifier que le modèle vierge existe
-    if not os.path.exists(MODELE_VIERGE_PATH):
+    if not modele_existe():
         raise HTTPException(status_code=500, detail="Le fichier modèle vierge n'a pas été trouvé")
-    
-    # Convertir la chaîne de pages en liste d'entiers
+
+    # Pages validées nativement par Pydantic (422 automatique si invalide)
+    pages_to_compare = pages
+
+    # Extraire les différences directement depuis les octets uploadés
     try:
-        pages_to_compare = [int(p.strip()) for p in pages.split(',')]
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Format de pages invalide. Utilisez des nombres séparés par des virgules (ex: '1,3,11,12')")
-    
-    # Créer un fichier temporaire pour le PDF uploadé
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-        try:
-            # Sauvegarder le fichier uploadé
-            content = await file.read()
-            temp_file.write(content)
-            temp_file.flush()
-            
-            # Extraire les différences
-            differences = extract_page_diffs(temp_file.name, MODELE_VIERGE_PATH, pages_to_compare)
-            
-            print(f"📊 Comparaison PDF effectuée par la clé: {api_key[:8]}... - Pages: {pages_to_compare}")
-            return JSONResponse(content=differences)
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Erreur lors du traitement : {str(e)}")
-        
-        finally:
-            # Nettoyer le fichier temporaire
-            try:
-                os.unlink(temp_file.name)
-            except:
-                pass
+        content = await file.read()
+        _, payload = await _compare_bytes(content, pages_to_compare)
+
+        logger.info("📊 Comparaison PDF effectuée par la clé: %s... - Pages: %s", api_key[:8], pages_to_compare)
+        # Payload déjà sérialisé (et mis en cache) : réponse sans ré-encodage
+        return Response(content=payload, media_type="application/json")
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erreur lors du traitement : {str(e)}")
 
 @app.post("/compare-pdf-base64")
 async def compare_pdf_base64(
@@ -261,8 +567,6 @@ async def compare_pdf_base64(
         "filename": "document.pdf"
     }
     """
-    import base64
-    
     try:
         # Extraire les données du request
         file_content = request.get("file_content", "")
@@ -270,92 +574,131 @@ async def compare_pdf_base64(
         filename = request.get("filename", "document.pdf")
         
         if not file_content:
-            return JSONResponse(
+            return DefaultResponse(
                 status_code=400,
                 content={"success": False, "error": "file_content manquant"}
             )
         
         # Vérifier que le modèle vierge existe
-        if not os.path.exists(MODELE_VIERGE_PATH):
-            return JSONResponse(
+        if not modele_existe():
+            return DefaultResponse(
                 status_code=500,
                 content={"success": False, "error": "Modèle vierge non trouvé"}
             )
         
         # Convertir et valider les pages
         try:
-            pages_to_compare = [int(p.strip()) for p in pages.split(',')]
+            pages_to_compare = parser_pages(pages)
         except ValueError:
-            return JSONResponse(
+            return DefaultResponse(
                 status_code=400,
                 content={"success": False, "error": "Format de pages invalide. Utilisez des nombres séparés par des virgules (ex: '1,3,11,12')"}
             )
         
         # Vérifier la taille
         if len(file_content) > 15000000:
-            return JSONResponse(
+            return DefaultResponse(
                 status_code=413,
                 content={"success": False, "error": "Fichier trop volumineux (max ~10MB)"}
             )
-        
+
+        # Vérifier l'en-tête avant de décoder tout le payload
+        if not base64_semble_pdf(file_content):
+            return DefaultResponse(
+                status_code=400,
+                content={"success": False, "error": "Pas un fichier PDF valide"}
+            )
+
         # Décoder le Base64
         try:
-            pdf_bytes = base64.b64decode(file_content)
-        except Exception as e:
-            return JSONResponse(
+            pdf_bytes = decoder_base64(file_content)
+        except ValueError as e:
+            return DefaultResponse(
                 status_code=400,
                 content={"success": False, "error": f"Base64 invalide: {str(e)}"}
             )
-        
+        # Libérer la chaîne source (~33% plus grosse que le PDF) au plus tôt
+        file_content = None
+        request["file_content"] = None
+
         # Vérifier que c'est un PDF
-        if not pdf_bytes.startswith(b'%PDF'):
-            return JSONResponse(
+        if not est_pdf(pdf_bytes):
+            return DefaultResponse(
                 status_code=400,
                 content={"success": False, "error": "Pas un fichier PDF valide"}
             )
         
-        # Traitement du PDF
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
-            try:
-                temp_file.write(pdf_bytes)
-                temp_file.flush()
-                
-                differences = extract_page_diffs(temp_file.name, MODELE_VIERGE_PATH, pages_to_compare)
-                
-                print(f"📊 Comparaison PDF Base64 effectuée par la clé: {api_key[:8]}... - Pages: {pages_to_compare}")
-                return JSONResponse(content={
-                    "success": True,
-                    "filename": filename,
-                    "pages_compared": pages_to_compare,
-                    "file_size_kb": len(pdf_bytes) // 1024,
-                    "differences": differences
-                })
-                
-            finally:
-                try:
-                    os.unlink(temp_file.name)
-                except:
-                    pass
-                    
+        # Traitement du PDF directement en mémoire
+        differences, _ = await _compare_bytes(pdf_bytes, pages_to_compare)
+
+        logger.info("📊 Comparaison PDF Base64 effectuée par la clé: %s... - Pages: %s", api_key[:8], pages_to_compare)
+        return DefaultResponse(content={
+            "success": True,
+            "filename": filename,
+            "pages_compared": pages_to_compare,
+            "file_size_kb": len(pdf_bytes) // 1024,
+            "differences": differences
+        })
+
+    except HTTPException as e:
+        # Conserver le statut et le détail (erreur d'extraction, clé API...)
+        # au lieu de les aplatir en 500 au message vide
+        return DefaultResponse(
+            status_code=e.status_code,
+            content={"success": False, "error": e.detail}
+        )
     except Exception as e:
-        return JSONResponse(
+        return DefaultResponse(
             status_code=500,
             content={"success": False, "error": f"Erreur serveur: {str(e)}"}
         )
 
+@app.post("/compare-pdf-raw")
+async def compare_pdf_raw(
+    request: Request,
+    pages: List[int] = Query(default=PAGES_A_COMPARER),  # ex: ?pages=1&pages=3&pages=11
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Compare un PDF envoyé en octets bruts (application/octet-stream).
+    Nécessite une clé API valide.
+
+    Évite totalement le Base64 : pas de payload gonflé de ~33% ni de décodage
+    côté serveur, donc un pic mémoire réduit de moitié pour les gros fichiers.
+    """
+    # Vérifier que le modèle vierge existe
+    if not modele_existe():
+        raise HTTPException(status_code=500, detail="Le fichier modèle vierge n'a pas été trouvé")
+
+    pdf_bytes = await request.body()
+    if not est_pdf(pdf_bytes):
+        raise HTTPException(status_code=400, detail="Le fichier ne semble pas être un PDF valide")
+
+    try:
+        _, payload = await _compare_bytes(pdf_bytes, pages)
+
+        logger.info("📊 Comparaison PDF brut effectuée par la clé: %s... - Pages: %s", api_key[:8], pages)
+        return Response(content=payload, media_type="application/json")
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erreur lors du traitement : {str(e)}")
+
 @app.get("/config")
 async def get_config(api_key: str = Depends(get_api_key)):
     """Retourne la configuration actuelle. Nécessite une clé API valide."""
     return {
         "modele_vierge_path": MODELE_VIERGE_PATH,
         "pages_par_defaut": PAGES_A_COMPARER,
-        "model_file_exists": os.path.exists(MODELE_VIERGE_PATH)
+        "model_file_exists": modele_existe()
     }
 
 if __name__ == "__main__":
-    # Lancer le serveur de développement
+    # Lancer le serveur (uvloop + httptools, un worker par cœur)
     port = int(os.getenv("PORT", 8000))
-    print(f"🚀 Serveur démarré sur http://localhost:{port}")
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+    print(f"🚀 Serveur démarré sur http://localhost:{port} ({workers} workers)")
     print(f"📖 Documentation interactive : http://localhost:{port}/docs")
     print(f"🔐 Clé API configurée : {'✅ Oui' if os.getenv('API_KEY') else '❌ Non'}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)